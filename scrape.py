@@ -1,13 +1,18 @@
 """Scrapes recreation.gov and sends an email when permits are available.
 
 The script expects a local smtp server to have been setup for email
-notifications.
+notifications. It needs Python 3.9+ and a timezone database; on systems
+without one (e.g. Windows) install the tzdata package from PyPI.
 
 Sample commands:
-1) For recreation.gov
+1) For recreation.gov. Availability is polled through the JSON API and a
+   browser is only started to add a requested date to the cart.
 python3 scrape.py --scrape_interval_secs=600 --email_addr=foo@bar.com \
         --mode=permits --chrome_user_data_dir=/home/user/.config/chrome/Profile/
 
+   Use --mode=permits_browser to scrape the availability page with selenium
+   instead.
+
 2) To get notifications about WA ferries
 python3 scrape.py --scrape_interval_secs=60 --email_addr=foo@bar.com \
         --mode=ferry --ferry_from="Orcas Island" --ferry_to="Anacortes" \
@@ -22,18 +27,31 @@ python3 scrape.py --scrape_interval_secs=60 --email_addr=foo@bar.com \
 
 """
 
+import collections.abc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 from datetime import datetime as dt
 from datetime import timedelta
+import atexit
 import email.message
 import email.utils
+import json
+import os
+import queue
 import smtplib
+import threading
 import time
+from zoneinfo import ZoneInfo
 
 from absl import flags
 from absl import app
-import pytz
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from selenium import webdriver
+from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
@@ -42,8 +60,17 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import Select
 from selenium.webdriver.support.wait import WebDriverWait
 
+# orjson is optional; it parses the monthly availability responses several
+# times faster than the json module.
+try:
+  import orjson
+  _json_loads = orjson.loads
+except ImportError:
+  _json_loads = json.loads
+
 FLAGS = flags.FLAGS
-flags.DEFINE_enum("mode", "permits", ["permits", "permits_json", "ferry"],
+flags.DEFINE_enum("mode", "permits",
+                  ["permits", "permits_browser", "permits_json", "ferry"],
                   "Which mode to run the script in")
 flags.DEFINE_bool("headless", True, "If true, runs chrome in headless mode")
 flags.DEFINE_string(
@@ -88,15 +115,114 @@ flags.DEFINE_list(
     "permit_api_months_to_query", "2020-07-01,2020-08-01",
     "First day of the month for months that need to be queried for permit "
     "availability")
+flags.DEFINE_string(
+    "permit_api_cache_dir", None,
+    "If set, monthly availability responses are saved here so that restarts "
+    "can revalidate them with the server instead of downloading them again")
+
+EST_TZ = ZoneInfo("America/New_York")
 
 # Only notify once per date
 skip_notification_date_set = set()
 
+# Row of the detailed availability table holding the number of permits left.
+PERMIT_ROW_XPATH = (
+    '//*[@id="per-availability-main"]/div/div[1]/div[3]/div[2]/div/table/tbody'
+    '/tr[5]')
+PERMIT_CELL_XPATH = PERMIT_ROW_XPATH + '/td[%d]'
+
+# Resources that aren't needed to render the availability tables. CSS and JS
+# are still loaded so that the dynamic tables render.
+BLOCKED_URL_PATTERNS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.woff", "*.woff2",
+    "*google-analytics*", "*googletagmanager*", "*doubleclick*", "*facebook*"
+]
+
+# Scripts that read a whole table in a single webdriver call instead of one
+# call per cell.
+ROW_CELLS_SCRIPT = """
+var row = document.evaluate(arguments[0], document, null,
+    XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+return row ? Array.from(row.cells, c => c.innerText.trim()) : [];
+"""
+FERRY_SCHEDULE_SCRIPT = """
+return Array.from(
+    document.querySelectorAll('#MainContent_gvschedule > tbody > tr'))
+  .filter(r => r.cells.length > 2 && r.cells[1].tagName == 'TD')
+  .map(r => [r.cells[1].innerText.trim(), r.cells[2].innerText.trim()]);
+"""
 
-def send_email(to_email, subject, body):
-  if FLAGS.email_addr is None:
-    print("Please specify email_addr to send email notifications")
+PERMIT_API_HEADERS = {
+    "content-type":
+        "application/json",
+    "cache-control":
+        "no-cache, no-store, must-revalidate",
+    "user-agent":
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_4) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/83.0.4103.106 Safari/537.36",
+}
+
+# (connect, read) timeouts so stalled connections are retried.
+PERMIT_API_TIMEOUT = (5, 15)
+
+# Shared across loop iterations so the connection to recreation.gov is reused.
+# Transient server errors are retried with backoff.
+_session = requests.Session()
+_session.headers.update(PERMIT_API_HEADERS)
+_session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=4,
+                pool_maxsize=8,
+                max_retries=Retry(total=3,
+                                  backoff_factor=0.5,
+                                  status_forcelist=[502, 503, 504])))
+
+# Month start -> (ETag, availability) of the last response for that month.
+_etag_cache = {}
+
+SMTP_HOST = "localhost"
+# Keeps a stalled mail server from blocking the mail worker forever.
+SMTP_TIMEOUT_SECS = 30
+
+# SMTP connection reused across notifications, only used from the mail
+# worker thread. It is recycled after
+# SMTP_MAX_MESSAGES_PER_CONNECTION messages so rate limited relays don't
+# throttle a single long lived connection.
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100
+_smtp = None
+_smtp_num_sent = 0
+
+
+def _close_smtp():
+  global _smtp
+  if _smtp is None:
     return
+  try:
+    _smtp.quit()
+  except (smtplib.SMTPException, OSError):
+    pass
+  _smtp = None
+
+
+def _get_smtp():
+  global _smtp, _smtp_num_sent
+  if _smtp is not None and _smtp_num_sent >= SMTP_MAX_MESSAGES_PER_CONNECTION:
+    _close_smtp()
+  if _smtp is not None:
+    try:
+      healthy = _smtp.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+      healthy = False
+    if not healthy:
+      _close_smtp()
+  if _smtp is None:
+    _smtp = smtplib.SMTP(SMTP_HOST, timeout=SMTP_TIMEOUT_SECS)
+    _smtp_num_sent = 0
+  return _smtp
+
+
+def _deliver_email(to_email, subject, body):
+  global _smtp_num_sent
   msg = email.message.Message()
   msg['From'] = to_email
   msg['To'] = to_email
@@ -104,58 +230,142 @@ def send_email(to_email, subject, body):
   msg.add_header('Content-Type', 'text')
   msg.set_payload(body)
 
-  print("Sending email with subject '%s' to %s" % (subject, to_email))
-  smtp_obj = smtplib.SMTP("localhost")
+  smtp_obj = _get_smtp()
   smtp_obj.sendmail(msg['From'], [msg['To']], msg.as_string())
-  smtp_obj.quit()
+  _smtp_num_sent += 1
+
+
+# Emails are sent from a background thread so that a slow mail server doesn't
+# delay the scraping loops. None stops the worker.
+_mail_queue = queue.Queue()
 
 
-def maybe_send_notification(date_set):
-  filtered_dates = sorted(date_set - skip_notification_date_set)
-  skipped_dates = sorted(date_set.intersection(skip_notification_date_set))
+def _mail_worker():
+  while True:
+    item = _mail_queue.get()
+    if item is None:
+      _close_smtp()
+      return
+    # Don't let one bad message stop all future notifications.
+    try:
+      _deliver_email(*item)
+    except Exception as e:
+      print("Error sending email with subject '%s': %s" % (item[1], str(e)))
+      _close_smtp()
+
+
+_mail_thread = threading.Thread(target=_mail_worker, daemon=True)
+_mail_thread.start()
+
+
+def _stop_mail_worker():
+  """Sends any queued emails before exiting."""
+  _mail_queue.put(None)
+  _mail_thread.join(timeout=30)
+
+
+atexit.register(_stop_mail_worker)
+
+
+def send_email(to_email, subject, body):
+  print("Sending email with subject '%s' to %s" % (subject, to_email))
+  _mail_queue.put((to_email, subject, body))
+
+
+def _format_notification_key(key):
+  if isinstance(key, date):
+    return key.strftime("%m/%d")
+  return key
+
+
+def maybe_send_notification(date_set, email_addr):
+  """Sends an email for dates (or ferry times) that weren't notified yet.
+
+  date_set can be any iterable. Sets and dict key views are used as is.
+  """
+  if not isinstance(date_set, collections.abc.Set):
+    date_set = set(date_set)
+  skipped_dates = date_set & skip_notification_date_set
   if len(skipped_dates) > 0:
-    print("Skipping already notified dates " + ", ".join(skipped_dates))
-  if len(filtered_dates) == 0:
+    print("Skipping already notified dates " +
+          ", ".join(map(_format_notification_key, sorted(skipped_dates))))
+  if len(skipped_dates) == len(date_set):
     return
-  subject = "Found %s availability for %s" % (FLAGS.mode,
-                                              ", ".join(filtered_dates))
-  send_email(FLAGS.email_addr, subject, subject)
+  filtered_dates = sorted(date_set - skipped_dates)
+  subject = "Found %s availability for %s" % (
+      FLAGS.mode, ", ".join(map(_format_notification_key, filtered_dates)))
+  send_email(email_addr, subject, subject)
   skip_notification_date_set.update(filtered_dates)
 
 
+def safe_find(driver, xpath, timeout=5):
+  """Waits for the element at xpath, returning None if it doesn't appear."""
+  try:
+    return WebDriverWait(driver, timeout, poll_frequency=0.1).until(
+        EC.presence_of_element_located((By.XPATH, xpath)))
+  except TimeoutException:
+    return None
+
+
 def select_permit_options(driver):
   overnight = Select(
-      driver.find_element_by_xpath('//*[@id="division-selection"]'))
+      WebDriverWait(driver, 10).until(
+          EC.element_to_be_clickable(
+              (By.XPATH, '//*[@id="division-selection"]'))))
   overnight.select_by_visible_text("Overnight")
 
-  time.sleep(1)
   people = Select(
-      driver.find_element_by_xpath('//*[@id="quota-view-selector"]'))
+      WebDriverWait(driver, 10).until(
+          EC.element_to_be_clickable(
+              (By.XPATH, '//*[@id="quota-view-selector"]'))))
   people.select_by_visible_text("People")
 
   # Select number of people in the group
-  group_dropdown = driver.find_element_by_xpath(
-      '//*[@id="guest-counter-QuotaUsageByMember"]/span[1]')
+  group_dropdown = WebDriverWait(driver, 5).until(
+      EC.element_to_be_clickable(
+          (By.XPATH, '//*[@id="guest-counter-QuotaUsageByMember"]/span[1]')))
   group_dropdown.click()
-  group_size = driver.find_element_by_xpath(
-      '//*[@id="guest-counter-QuotaUsageByMember-popup"]/div/div[1]/div/div/div[1]/div[2]/div/div/button[2]'
-  )
+  group_size = WebDriverWait(driver, 5).until(
+      EC.element_to_be_clickable((
+          By.XPATH,
+          '//*[@id="guest-counter-QuotaUsageByMember-popup"]/div/div[1]/div/div/div[1]/div[2]/div/div/button[2]'
+      )))
   # Look for permits for the requested number of people
   for _ in range(0, FLAGS.permit_desired_slots):
     group_size.click()
   group_dropdown.click()
 
 
-def maybe_add_to_cart_and_sleep(driver, availability_map):
+def parse_cart_dates(date_strs):
+  """Returns (month, day) tuples for MM/DD strings, raising ValueError for
+  malformed ones."""
+  cart_dates = []
+  for date_str in date_strs:
+    try:
+      month, day = map(int, date_str.split('/'))
+    except ValueError:
+      raise ValueError("Invalid date '%s' (Format: MM/DD)" % date_str)
+    if not 1 <= month <= 12 or not 1 <= day <= 31:
+      raise ValueError("Invalid date '%s' (Format: MM/DD)" % date_str)
+    cart_dates.append((month, day))
+  return cart_dates
+
+
+def find_date_to_add_to_cart(availability_map, cart_dates):
+  """Returns the first of the (month, day) cart_dates that is available, or
+  None."""
+  available = {(day.month, day.day): day for day in availability_map}
+  for month_day in cart_dates:
+    if month_day in available:
+      return available[month_day]
+  return None
+
+
+def maybe_add_to_cart_and_sleep(driver, availability_map, cart_dates):
   if len(availability_map) == 0:
     return
 
-  book_date = None
-  for date in FLAGS.permit_dates_to_add_to_cart:
-    if date in availability_map.keys():
-      book_date = date
-      break
-
+  book_date = find_date_to_add_to_cart(availability_map, cart_dates)
   if book_date is None:
     print("Requested dates unavailable. Not adding to cart")
     return
@@ -164,212 +374,497 @@ def maybe_add_to_cart_and_sleep(driver, availability_map):
   permit_val = driver.find_element_by_xpath(availability_map[book_date])
   permit_val.click()
 
-  book_button = driver.find_element_by_xpath(
-      '//*[@id="per-availability-main"]/div/div[1]/div[3]/div[3]/div/div/div/button'
-  )
+  book_button = WebDriverWait(driver, 5).until(
+      EC.element_to_be_clickable((
+          By.XPATH,
+          '//*[@id="per-availability-main"]/div/div[1]/div[3]/div[3]/div/div/div/button'
+      )))
   book_button.click()
 
   #time.sleep(5)
   WebDriverWait(driver, 5).until(
       EC.presence_of_element_located((By.ID, 'add-permit-to-cart-button')))
-  end_dt = dt.strptime(book_date + "/2020", "%m/%d/%Y") + timedelta(days=2)
-  exit_elem = driver.find_element_by_id('exitDateCalendar')
+  end_dt = book_date + timedelta(days=2)
+  exit_elem = WebDriverWait(driver, 5).until(
+      EC.element_to_be_clickable((By.ID, 'exitDateCalendar')))
   exit_elem.click()
   exit_elem.send_keys(end_dt.strftime("%m/%d/%Y"))
 
-  agree_elem = driver.find_element_by_xpath(
-      '//*[@id="form-name"]/fieldset/section/div[3]/label/span')
+  agree_elem = WebDriverWait(driver, 5).until(
+      EC.element_to_be_clickable(
+          (By.XPATH,
+           '//*[@id="form-name"]/fieldset/section/div[3]/label/span')))
   agree_elem.click()
 
   while True:
-    add_to_cart_button = driver.find_element_by_id('add-permit-to-cart-button')
+    add_to_cart_button = WebDriverWait(driver, 5).until(
+        EC.element_to_be_clickable((By.ID, 'add-permit-to-cart-button')))
     actions = ActionChains(driver)
     actions.click(add_to_cart_button)
     actions.perform()
     print("Added permit to cart. Sleeping for 500 seconds before modifying...")
     time.sleep(500)
-    modify_elem = driver.find_element_by_xpath(
-        '//*[@id="page-body"]/div/div/div/div[1]/div[1]/div/div[2]/div[1]/div[4]/button[1]/span'
-    )
+    modify_elem = WebDriverWait(driver, 5).until(
+        EC.element_to_be_clickable((
+            By.XPATH,
+            '//*[@id="page-body"]/div/div/div/div[1]/div[1]/div/div[2]/div[1]/div[4]/button[1]/span'
+        )))
     modify_elem.click()
     WebDriverWait(driver, 5).until(
         EC.presence_of_element_located((By.ID, "exitDateCalendar")))
 
 
+def permit_page_url(url, est_now):
+  return "%s?date=%s" % (url, est_now.strftime("%Y-%m-%d"))
+
+
+def load_permit_table(driver, url, est_now):
+  """Returns the first availability cell, or None if the table didn't load."""
+  driver.get(permit_page_url(url, est_now))
+  select_permit_options(driver)
+  print("Waiting for the dynamic table to load...")
+  return safe_find(driver, PERMIT_CELL_XPATH % 2, timeout=10)
+
+
+def selected_permit_options(driver):
+  """Returns the labels of the selected division, quota view and group size."""
+  division = Select(driver.find_element_by_id("division-selection"))
+  quota_view = Select(driver.find_element_by_id("quota-view-selector"))
+  group_size = driver.find_element_by_xpath(
+      '//*[@id="guest-counter-QuotaUsageByMember"]/span[1]')
+  return (division.first_selected_option.text,
+          quota_view.first_selected_option.text, group_size.text)
+
+
+def _switch_quota_view(driver, row, quota_view_text):
+  """Selects quota_view_text and waits for row to be re-rendered. Returns the
+  new row."""
+  quota_view = Select(driver.find_element_by_id("quota-view-selector"))
+  quota_view.select_by_visible_text(quota_view_text)
+  WebDriverWait(driver, 5).until(EC.staleness_of(row))
+  return WebDriverWait(driver, 5).until(
+      EC.presence_of_element_located((By.XPATH, PERMIT_ROW_XPATH)))
+
+
+def refresh_permit_table(driver, permit_options):
+  """Re-renders the already loaded availability table without reloading the
+  page by switching the quota view away from "People" and back. Returns the
+  first availability cell, or None if the table wasn't re-rendered with the
+  same permit_options and the page needs a full load."""
+  try:
+    row = driver.find_element_by_xpath(PERMIT_ROW_XPATH)
+    quota_view = Select(driver.find_element_by_id("quota-view-selector"))
+    other_views = [
+        option.text for option in quota_view.options if option.text != "People"
+    ]
+    if len(other_views) == 0:
+      return None
+    row = _switch_quota_view(driver, row, other_views[0])
+    _switch_quota_view(driver, row, "People")
+    if selected_permit_options(driver) != permit_options:
+      return None
+  except (NoSuchElementException, TimeoutException):
+    return None
+  return safe_find(driver, PERMIT_CELL_XPATH % 2)
+
+
 def permit_loop(driver):
   num = 0
+  url = FLAGS.permit_availability_url
+  interval = FLAGS.scrape_interval_secs
+  email_addr = FLAGS.email_addr
+  cart_dates = parse_cart_dates(FLAGS.permit_dates_to_add_to_cart)
+  loaded_page_url = None
+  permit_options = None
+  # In place refreshes are given up on after this many failures in a row.
+  max_refresh_failures = 3
+  refresh_failures = 0
   while True:
     print("Running scraping loop %d" % num)
     num += 1
-    est_tz = pytz.timezone("US/Eastern")
-    est_now = dt.now(tz=est_tz)
-    today_date = est_now.strftime("%Y-%m-%d")
-    driver.get("%s?date=%s" % (FLAGS.permit_availability_url, today_date))
+    est_now = dt.now(tz=EST_TZ)
+    page_url = permit_page_url(url, est_now)
     # TODO: For some reason the page doesn't fully load every so often. Catch
-    # the exception and simply retry.
+    # the exception and simply retry on the next loop.
+    adding_to_cart = False
     try:
-      select_permit_options(driver)
-      print("Waiting 5 seconds for the dynamic table to load...")
-      time.sleep(5)
+      # Only the table needs to be refreshed while the date hasn't changed.
+      # Fall back to loading the whole page if that doesn't work.
+      cell = None
+      if (refresh_failures < max_refresh_failures and
+          page_url == loaded_page_url):
+        cell = refresh_permit_table(driver, permit_options)
+        if cell is None:
+          refresh_failures += 1
+          print("Couldn't refresh the table in place. Reloading the page...")
+        else:
+          refresh_failures = 0
+      if cell is None:
+        loaded_page_url = None
+        cell = load_permit_table(driver, url, est_now)
+        if cell is None:
+          print("Availability table didn't load. Rerunning loop...")
+          time.sleep(interval)
+          continue
+        permit_options = selected_permit_options(driver)
+      loaded_page_url = page_url
 
-      # Read 7 days of permit info.
+      # Read 7 days of permit info. The first cell of the row is its label.
       availability_map = {}
-      for ii in range(2, 9):
-        val_xpath = ('//*[@id="per-availability-main"]/div/div[1]/div[3]/div[2]'
-                     '/div/table/tbody/tr[5]/td[%d]') % ii
-
-        val = driver.find_element_by_xpath(val_xpath)
-        if val.text == '':
+      today = est_now.date()
+      cells = driver.execute_script(ROW_CELLS_SCRIPT, PERMIT_ROW_XPATH)
+      for ii, val_text in enumerate(cells[1:8], start=2):
+        if val_text == '':
           continue
-        num_slots = int(val.text)
+        num_slots = int(val_text)
         if num_slots > 0:
-          day_month_str = (est_now + timedelta(days=(ii - 2))).strftime("%m/%d")
-          print("Found availability on %s" % day_month_str)
-          availability_map[day_month_str] = val_xpath
-      maybe_send_notification(set(availability_map.keys()))
+          day = today + timedelta(days=(ii - 2))
+          print("Found availability on %s" % day)
+          availability_map[day] = PERMIT_CELL_XPATH % ii
+      maybe_send_notification(availability_map.keys(), email_addr)
+
+      # Errors from here on may happen after we started booking the
+      # reservation, so don't reload the page. Give the user at least 10
+      # minutes to finish booking.
+      adding_to_cart = True
+      maybe_add_to_cart_and_sleep(driver, availability_map, cart_dates)
+    except (WebDriverException, ValueError) as e:
+      print("Error: %s. Rerunning loop..." % str(e))
+      loaded_page_url = None
+      time.sleep(600 if adding_to_cart else interval)
+      continue
     except Exception as e:
+      if not adding_to_cart:
+        raise
       print("Error: %s. Rerunning loop..." % str(e))
-      time.sleep(1)
+      loaded_page_url = None
+      time.sleep(600)
       continue
 
-    # Try this separately as we may have started booking the reservation and we
-    # don't want reload the page. Give the user at least 10 minutes to finish
-    # booking.
+    print("Sleeping %d seconds before running next loop..." % interval)
+    time.sleep(interval)
+
+
+def permit_loop_json(driver=None):
+  num = 0
+  url = FLAGS.permit_availability_url
+  interval = FLAGS.scrape_interval_secs
+  email_addr = FLAGS.email_addr
+  cart_dates = parse_cart_dates(FLAGS.permit_dates_to_add_to_cart)
+  desired_slots = FLAGS.permit_desired_slots
+  while True:
+    print("Running scraping loop %d" % num)
+    num += 1
+    est_now = dt.now(tz=EST_TZ)
+    # Same 7 days as the detailed availability table.
+    today = est_now.date()
+    days = [today + timedelta(days=ii) for ii in range(7)]
+    month_starts = sorted(set(day.strftime("%Y-%m-01") for day in days))
+    remaining = {}
     try:
-      maybe_add_to_cart_and_sleep(driver, availability_map)
+      for month_start in month_starts:
+        remaining.update(fetch_permit_availability(month_start))
     except Exception as e:
-      print("Error: %s. Rerunning loop..." % str(e))
-      time.sleep(600)
+      print("Error: %s. Rerunning loop after sleeping 1 minute..." % str(e))
+      time.sleep(60)
       continue
 
-    print("Sleeping %d seconds before running next loop..." % \
-            FLAGS.scrape_interval_secs)
-    time.sleep(FLAGS.scrape_interval_secs)
+    availability_map = {}
+    # Only dates with enough permits for the whole group can be booked.
+    bookable_map = {}
+    for ii, day in enumerate(days):
+      num_slots = remaining.get(day, 0)
+      if num_slots > 0:
+        print("Found availability on %s" % day)
+        availability_map[day] = PERMIT_CELL_XPATH % (ii + 2)
+      if num_slots >= desired_slots:
+        bookable_map[day] = availability_map[day]
+    maybe_send_notification(availability_map.keys(), email_addr)
+
+    # Only start the browser once one of the requested dates can be booked.
+    if find_date_to_add_to_cart(bookable_map, cart_dates) is not None:
+      try:
+        if driver is None:
+          driver = make_driver()
+        cell = load_permit_table(driver, url, est_now)
+      except WebDriverException as e:
+        cell = None
+        print("Error: %s" % str(e))
+      if cell is None:
+        print("Availability table didn't load. Rerunning loop...")
+        time.sleep(interval)
+        continue
+      # Give the user at least 10 minutes to finish booking on failure.
+      try:
+        maybe_add_to_cart_and_sleep(driver, bookable_map, cart_dates)
+      except Exception as e:
+        print("Error: %s. Rerunning loop..." % str(e))
+        time.sleep(600)
+        continue
+
+    print("Sleeping %d seconds before running next loop..." % interval)
+    time.sleep(interval)
 
 
 def select_ferry_options(driver):
   start = Select(
       driver.find_element_by_xpath('//*[@id="MainContent_dlFromTermList"]'))
   start.select_by_visible_text(FLAGS.ferry_from)
-  time.sleep(2)
+  # The destination list is repopulated once the start terminal is selected.
+  WebDriverWait(driver, 10).until(
+      EC.presence_of_element_located(
+          (By.XPATH, '//*[@id="MainContent_dlToTermList"]/option'
+           '[normalize-space()="%s"]' % FLAGS.ferry_to)))
   end = Select(
       driver.find_element_by_xpath('//*[@id="MainContent_dlToTermList"]'))
   end.select_by_visible_text(FLAGS.ferry_to)
-  time.sleep(2)
-  date = driver.find_element_by_xpath('//*[@id="MainContent_txtDatePicker"]')
-  date.click()
-  date.send_keys(Keys.CONTROL, 'a')
-  date.send_keys(Keys.BACKSPACE)
-  date.send_keys(FLAGS.ferry_date)
-  date.send_keys(Keys.ESCAPE)
+  date_picker = WebDriverWait(driver, 10).until(
+      EC.element_to_be_clickable(
+          (By.XPATH, '//*[@id="MainContent_txtDatePicker"]')))
+  date_picker.click()
+  date_picker.send_keys(Keys.CONTROL, 'a')
+  date_picker.send_keys(Keys.BACKSPACE)
+  date_picker.send_keys(FLAGS.ferry_date)
+  date_picker.send_keys(Keys.ESCAPE)
 
   vehicle_size = Select(
-      driver.find_element_by_xpath('//*[@id="MainContent_dlVehicle"]'))
+      WebDriverWait(driver, 10).until(
+          EC.element_to_be_clickable(
+              (By.XPATH, '//*[@id="MainContent_dlVehicle"]'))))
   vehicle_size.select_by_index(2)
-  time.sleep(2)
   vehicle_height = Select(
-      driver.find_element_by_xpath('//*[@id="MainContent_ddlCarTruck14To22"]'))
+      WebDriverWait(driver, 10).until(
+          EC.element_to_be_clickable(
+              (By.XPATH, '//*[@id="MainContent_ddlCarTruck14To22"]'))))
   vehicle_height.select_by_index(1)
-  time.sleep(2)
-  show_avail = driver.find_element_by_xpath(
-      '//*[@id="MainContent_btnContinue"]/h4')
+  show_avail = WebDriverWait(driver, 10).until(
+      EC.element_to_be_clickable(
+          (By.XPATH, '//*[@id="MainContent_btnContinue"]/h4')))
   show_avail.click()
-  time.sleep(2)
+  WebDriverWait(driver, 10).until(
+      EC.presence_of_element_located((By.ID, "MainContent_gvschedule")))
+
+
+def _parse_time(time_str):
+  """Returns minutes since midnight for a time like '4:30 PM', raising
+  ValueError for malformed ones."""
+  error = ValueError("Invalid time '%s' (Format: HH:MM AM/PM)" % time_str)
+  try:
+    hhmm, ampm = time_str.strip().rsplit(' ', 1)
+    hours, minutes = map(int, hhmm.split(':'))
+  except ValueError:
+    raise error
+  if not 1 <= hours <= 12 or not 0 <= minutes <= 59:
+    raise error
+  ampm = ampm.upper()
+  if ampm == 'AM':
+    hours %= 12
+  elif ampm == 'PM':
+    hours = hours % 12 + 12
+  else:
+    raise error
+  return hours * 60 + minutes
 
 
 def ferry_reservation_loop(driver):
   num = 0
-  time_fmt = '%I:%M %p'
-  depart_after = dt.strptime(FLAGS.ferry_depart_after.strip(), time_fmt)
-  depart_before = dt.strptime(FLAGS.ferry_depart_before.strip(), time_fmt)
-  driver.get(FLAGS.ferry_url)
-  select_ferry_options(driver)
+  depart_after_min = _parse_time(FLAGS.ferry_depart_after)
+  depart_before_min = _parse_time(FLAGS.ferry_depart_before)
+  interval = FLAGS.scrape_interval_secs
+  email_addr = FLAGS.email_addr
+  needs_reload = True
   while True:
     print("Running scraping loop %d" % num)
     num += 1
 
     times_available = set()
     try:
-      times = driver.find_elements_by_xpath(
-          '//*[@id="MainContent_gvschedule"]/tbody/tr/td[2]')
-      availability = driver.find_elements_by_xpath(
-          '//*[@id="MainContent_gvschedule"]/tbody/tr/td[3]')
-      for ii in range(len(times)):
-        time_str = times[ii].text.strip()
-        avail_str = availability[ii].text.strip()
-        ferry_time = dt.strptime(time_str, time_fmt)
-        if ferry_time < depart_after or ferry_time > depart_before:
+      if needs_reload:
+        driver.get(FLAGS.ferry_url)
+        select_ferry_options(driver)
+        needs_reload = False
+      rows = driver.execute_script(FERRY_SCHEDULE_SCRIPT)
+      for time_str, avail_str in rows:
+        ferry_time_min = _parse_time(time_str)
+        if not depart_after_min <= ferry_time_min <= depart_before_min:
           continue
-        if avail_str.find("Space Available") >= 0:
+        if "Space Available" in avail_str:
           times_available.add(time_str)
-    except Exception as e:
-      print("Error: %s. Rerunning loop after sleeping 1 minute..." % str(e))
-      time.sleep(60)
+    except (WebDriverException, ValueError) as e:
+      print("Error: %s. Rerunning loop..." % str(e))
+      needs_reload = True
+      time.sleep(interval)
       continue
-    maybe_send_notification(times_available)
-    print("Sleeping %d seconds before running next loop..." % \
-            FLAGS.scrape_interval_secs)
-    time.sleep(FLAGS.scrape_interval_secs)
-    refresh = driver.find_element_by_xpath(
-        '//*[@id="MainContent_btnRefresh"]/h4')
-    refresh.click()
-    time.sleep(2)
+    maybe_send_notification(times_available, email_addr)
+    print("Sleeping %d seconds before running next loop..." % interval)
+    time.sleep(interval)
+    # A slow or failed postback shouldn't stop the scraper; reload the page
+    # on the next loop instead.
+    try:
+      schedule = driver.find_element_by_id("MainContent_gvschedule")
+      refresh = driver.find_element_by_xpath(
+          '//*[@id="MainContent_btnRefresh"]/h4')
+      refresh.click()
+      WebDriverWait(driver, 10).until(EC.staleness_of(schedule))
+      WebDriverWait(driver, 10).until(
+          EC.presence_of_element_located((By.ID, "MainContent_gvschedule")))
+    except WebDriverException as e:
+      print("Error refreshing the schedule: %s. Reloading the page..." % str(e))
+      needs_reload = True
+
+
+def parse_permit_availability(avail_json):
+  all_availability = avail_json['payload']['availability']
+  core_availability = all_availability['30']['date_availability']
+  remaining = {}
+  for k, v in core_availability.items():
+    remaining[date.fromisoformat(k[0:10])] = v['remaining']
+  return remaining
+
+
+def _permit_cache_path(month_start):
+  return os.path.join(FLAGS.permit_api_cache_dir,
+                      "permit_%s.json" % month_start)
+
+
+def _load_cached_month(month_start):
+  if month_start in _etag_cache:
+    return _etag_cache[month_start]
+  if FLAGS.permit_api_cache_dir is None:
+    return None
+  # Ignore unreadable or malformed files; they are overwritten by the next
+  # successful response.
+  try:
+    with open(_permit_cache_path(month_start)) as f:
+      cached = json.load(f)
+    entry = (cached['etag'], parse_permit_availability(cached['response']))
+  except (OSError, ValueError, KeyError, TypeError):
+    return None
+  _etag_cache[month_start] = entry
+  return entry
+
+
+def _save_cached_month(month_start, etag, avail_json, remaining):
+  _etag_cache[month_start] = (etag, remaining)
+  if FLAGS.permit_api_cache_dir is None:
+    return
+  try:
+    os.makedirs(FLAGS.permit_api_cache_dir, exist_ok=True)
+    # Write to a temporary file first so an interrupted write doesn't leave
+    # a truncated cache file behind.
+    path = _permit_cache_path(month_start)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+      json.dump({'etag': etag, 'response': avail_json}, f)
+    os.replace(tmp_path, path)
+  except OSError as e:
+    print("Error caching availability for %s: %s" % (month_start, str(e)))
+
+
+def fetch_permit_availability(month_start):
+  """Returns a dict of date -> remaining permits for the month starting on
+  month_start (Format: YYYY-MM-DD)."""
+  url = "%s?start_date=%sT00:00:00.000Z" % (FLAGS.permit_api_url, month_start)
+  headers = {}
+  cached = _load_cached_month(month_start)
+  if cached is not None:
+    headers["If-None-Match"] = cached[0]
+  response = _session.get(url, headers=headers, timeout=PERMIT_API_TIMEOUT)
+  if response.status_code == 304 and cached is not None:
+    return cached[1]
+  if response.status_code != 200:
+    print("Error fetching URL %s: Received HTTP status code %s" %
+          (url, str(response.status_code)))
+    return {}
+  avail_json = _json_loads(response.content)
+  remaining = parse_permit_availability(avail_json)
+  etag = response.headers.get("ETag")
+  if etag is not None:
+    _save_cached_month(month_start, etag, avail_json, remaining)
+  return remaining
+
+
+def fetch_available_dates(month_start):
+  """Returns the set of dates with permits available in the given month, or
+  None if the month couldn't be fetched."""
+  try:
+    remaining = fetch_permit_availability(month_start)
+  except Exception as e:
+    print("Error fetching availability for %s: %s" % (month_start, str(e)))
+    return None
+  available_date_set = set()
+  for day, num_slots in remaining.items():
+    if num_slots > 0:
+      available_date_set.add(day)
+  return available_date_set
 
 
 def permit_json_loop():
   num = 0
-  while True:
-    print("Running scraping loop %d" % num)
-    num += 1
-    headers = {}
-    headers["content-type"] = "application/json"
-    headers["cache-control"] = "no-cache, no-store, must-revalidate"
-    headers["user-agent"] = (
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_4) AppleWebKit/537.36 "
-        "(KHTML, like Gecko) Chrome/83.0.4103.106 Safari/537.36")
-
-    available_date_set = set()
-    for start_date in FLAGS.permit_api_months_to_query:
-      url = "%s?start_date=%sT00:00:00.000Z" % (FLAGS.permit_api_url,
-                                                start_date)
-      response = None
-      try:
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-          print("Error fetching URL %s: Received HTTP status code %s" %
-                (url, str(response.status_code)))
+  months = FLAGS.permit_api_months_to_query
+  interval = FLAGS.scrape_interval_secs
+  email_addr = FLAGS.email_addr
+  # Fetch months concurrently, but keep the load on recreation.gov bounded.
+  with ThreadPoolExecutor(max_workers=4) as executor:
+    while True:
+      print("Running scraping loop %d" % num)
+      num += 1
+
+      available_date_set = set()
+      failed = False
+      for month_dates in executor.map(fetch_available_dates, months):
+        if month_dates is None:
+          failed = True
           continue
-      except Exception as e:
-        print("Error: %s. Rerunning loop after sleeping 1 minute..." % str(e))
+        available_date_set.update(month_dates)
+
+      maybe_send_notification(available_date_set, email_addr)
+      if failed:
+        print("Rerunning loop after sleeping 1 minute...")
         time.sleep(60)
         continue
-      avail_json = response.json()
-      all_availability = avail_json['payload']['availability']
-      core_availability = all_availability['30']['date_availability']
-      for k, v in core_availability.items():
-        date = k[0:10]
-        if v['remaining'] > 0:
-          available_date_set.add(date)
-
-    maybe_send_notification(available_date_set)
-    print("Sleeping %d seconds before running next loop..." % \
-            FLAGS.scrape_interval_secs)
-    time.sleep(FLAGS.scrape_interval_secs)
+      print("Sleeping %d seconds before running next loop..." % interval)
+      time.sleep(interval)
 
 
-def main(_):
-  if FLAGS.mode == "permits_json":
-    permit_json_loop()
-    return
-
+def make_driver():
   opts = Options()
   opts.add_argument('--user-data-dir=%s' % FLAGS.chrome_user_data_dir)
   if FLAGS.headless:
     opts.add_argument('--headless')
   driver = webdriver.Chrome(options=opts)
+  driver.execute_cdp_cmd("Network.enable", {})
+  driver.execute_cdp_cmd("Network.setBlockedURLs",
+                         {"urls": BLOCKED_URL_PATTERNS})
   driver.set_window_size(1920, 1080)
-  driver.implicitly_wait(3)
+  # Elements that are loaded dynamically are waited on explicitly, so lookups
+  # for missing elements should fail right away.
+  driver.implicitly_wait(0)
+  return driver
+
+
+def main(_):
+  if FLAGS.email_addr is None:
+    raise app.UsageError("--email_addr is required for email notifications")
+  try:
+    parse_cart_dates(FLAGS.permit_dates_to_add_to_cart)
+  except ValueError as e:
+    raise app.UsageError("--permit_dates_to_add_to_cart: %s" % str(e))
+  if FLAGS.mode == "ferry":
+    for flag_name in ["ferry_depart_after", "ferry_depart_before"]:
+      try:
+        _parse_time(FLAGS[flag_name].value)
+      except ValueError as e:
+        raise app.UsageError("--%s: %s" % (flag_name, str(e)))
+  if FLAGS.mode == "permits_json":
+    permit_json_loop()
+    return
   if FLAGS.mode == "permits":
+    permit_loop_json()
+    return
+
+  driver = make_driver()
+  if FLAGS.mode == "permits_browser":
     permit_loop(driver)
   else:
     ferry_reservation_loop(driver)